@@ -1,58 +1,93 @@
+import micropython
 import time
 from machine import I2C
 
+
+# constants are declared at module scope so the MicroPython emitter folds
+# them into the bytecode as immediate integers instead of attribute lookups
+
+# command selection bits send as data to the LCD
+CLEAR_DISPLAY = const(1)
+RETURN_HOME = const(2)
+ENTRY_MODE = const(4)
+DISPLAY_CONTROL = const(8)
+CURSOR_SHIFT = const(16)
+FUNCTION_CONTROL = const(32)
+SET_CGRAM = const(64)
+SET_DDRAM = const(128)
+
+# parameters for the entry mode command
+ENTRY_RIGHT = const(0)
+ENTRY_LEFT = const(2)
+DISPLAY_SHIFT_ENABLE = const(1)
+DISPLAY_SHIFT_DISABLE = const(0)
+
+
+# parameters for the display control command
+DISPLAY_ON = const(4)
+DISPLAY_OFF = const(0)
+CURSOR_ON = const(2)
+CURSOR_OFF = const(0)
+BLINK_ON = const(1)
+BLINK_OFF = const(0)
+
+# parameters for the cursur shift command
+DISPLAY_MOVE = const(8)
+CURSOR_MOVE = const(0)
+MOVE_RIGHT = const(4)
+MOVE_LEFT = const(0)
+
+# parameters for the function control command
+BIT_MODE_8 = const(16)
+BIT_MODE_4 = const(0)
+LINES_2 = const(8)
+LINES_1 = const(0)
+DOTS_5X10 = const(4)
+DOTS_5X8 = const(0)
+
+ENABLE = const(4)
+DATA = const(1)
+COMMAND = const(0)
+
+# bit used to control the backlight from P3 on the I2C adapter
+BACKLIGHT_ON = const(8)
+BACKLIGHT_OFF = const(0)
+
+# number of dirty cells in a row at which refresh rewrites the whole row
+FULL_ROW_THRESHOLD = const(8)
+
+# DDRAM base address of each row, the address of a cell is _ROW_BASE[row] + col
+_ROW_BASE = b"\x80\xc0\x94\xd4"
+
+
+@micropython.viper
+def _pack_send(buf : ptr8, off : int, data : int, flags : int):
+    """
+    Pack the 4 adapter states for one byte (enable high/low for each nibble)
+    into buf at off, where flags is the mode and backlight bits already ORed
+    together. Compiled to native code so the hot i2c paths avoid Python level
+    int boxing and call overhead. The viper emitter only supports up to 4
+    arguments, which is why mode and backlight arrive pre combined.
+
+    4 bytes is the minimum even when characters are streamed back to back:
+    the display latches a nibble only on the enable high to low edge, so
+    each enable low byte here is a required edge, not a hold state that
+    could be merged with the next byte's enable high.
+    """
+    high_nib = (data & 0xF0) | flags
+    low_nib = ((data << 4) & 0xF0) | flags
+    buf[off] = high_nib | ENABLE
+    buf[off + 1] = high_nib
+    buf[off + 2] = low_nib | ENABLE
+    buf[off + 3] = low_nib
+
+
 class CHAR_LCD_20_4:
     """
     Interface for communicating with the 20x4 LCD character display over i2c.
-    Contains methods and constants for writing to screen and configuring settings.
+    Contains methods for writing to screen and configuring settings using the
+    module level constants.
     """
-    # command selection bits send as data to the LCD
-    CLEAR_DISPLAY = const(1)
-    RETURN_HOME = const(2)
-    ENTRY_MODE = const(4)
-    DISPLAY_CONTROL = const(8)
-    CURSOR_SHIFT = const(16)
-    FUNCTION_CONTROL = const(32)
-    SET_CGRAM = const(64)
-    SET_DDRAM = const(128)
-
-    # parameters for the entry mode command
-    ENTRY_RIGHT = const(0)
-    ENTRY_LEFT = const(2)
-    DISPLAY_SHIFT_ENABLE = const(1)
-    DISPLAY_SHIFT_DISABLE = const(0)
-
-
-    # parameters for the display control command
-    DISPLAY_ON = const(4)
-    DISPLAY_OFF = const(0)
-    CURSOR_ON = const(2)
-    CURSOR_OFF = const(0)
-    BLINK_ON = const(1)
-    BLINK_OFF = const(0)
-
-    # parameters for the cursur shift command
-    DISPLAY_MOVE = const(8)
-    CURSOR_MOVE = const(0)
-    MOVE_RIGHT = const(4)
-    MOVE_LEFT = const(0)
-
-    # parameters for the function control command
-    BIT_MODE_8 = const(16)
-    BIT_MODE_4 = const(0)
-    LINES_2 = const(8)
-    LINES_1 = const(0)
-    DOTS_5X10 = const(4)
-    DOTS_5X8 = const(0)
-
-    ENABLE = const(4)
-    DATA = const(1)
-    COMMAND = const(0)
-
-    # bit used to control the backlight from P3 on the I2C adapter
-    BACKLIGHT_ON = const(8)
-    BACKLIGHT_OFF = const(0)
-
     # bit7 = db7
     # bit6 = db6
     # bit5 = db5
@@ -80,75 +115,69 @@ class CHAR_LCD_20_4:
         """
         self.i2c = i2c
         self.addr = addr
-        self.backlight = self.BACKLIGHT_ON
-
-        # each item in the list represents a row containing a sub list of columns
-        # self.ddram_map[row][column]
-        self.ddram_map = [[], [], [], []]
-        for col in range(128, 148):
-            self.ddram_map[0].append(col)
-        for col in range(192, 212):
-            self.ddram_map[1].append(col)
-        for col in range(148, 168):
-            self.ddram_map[2].append(col)
-        for col in range(212, 232):
-            self.ddram_map[3].append(col)
-        
+        # premasked backlight byte ORed into every packed adapter state byte
+        self.backlight = BACKLIGHT_ON
+
         # current cursor location
         self.cursor_loc = [0, 0]
 
-        # the current values writen to the display
-        self.ddram_value = [[], [], [], []]
-        for row in range(0,4):
-            for col in range(0, len(self.ddram_map[0])):
-                self.ddram_value[row].append(" ")
+        # the current values writen to the display as character codes, one bytearray per row
+        self.ddram_value = [bytearray(b" " * 20) for row in range(0, 4)]
+
+        # the text last passed to set_row for each row, used to skip unchanged rows
+        self._last_text = [None, None, None, None]
 
-        # ddram locations that need updating
-        self.refresh_loc = []
+        # per row bitmap of columns that need updating, bit n set = column n dirty
+        self.dirty = [0, 0, 0, 0]
+
+        # reusable scratch buffers so send and refresh do not allocate per call,
+        # the worst case refresh is 4 rows of 1 address command plus 20 characters
+        self._buf = bytearray(4)
+        self._refresh_buf = bytearray(4 * 4 * 21)
+
+        # lazily filled table of character code -> the 4 packed adapter state
+        # bytes for that character, invalidated when the backlight changes
+        self._data_tbl = [None] * 256
         
         print("Initializing LCD...")
         time.sleep(1)
-        self.write4bits(0 << 4)
-        self.write4bits(2 << 4)
+        self.pulse_enable(0 << 4)
+        self.pulse_enable(2 << 4)
         self.clear_display()
-        self.set_display_control(self.DISPLAY_ON, self.CURSOR_OFF, self.BLINK_OFF)
+        self.set_display_control(DISPLAY_ON, CURSOR_OFF, BLINK_OFF)
         print("LCD initialized")
 
-    def send(self, data : int, mode : int) -> None:
+    def _send_cmd(self, data : int) -> None:
         """
-        Used internally to write a byte to the display 4 bits at a time.
+        Used internally to write a command byte to the display in one i2c transaction.
 
         Parameters
         ----------
         data : int
-            byte to write to the display
-        mode : int
-            bits indicating the mode of the display (typically 0 unless sending a command)
+            command byte to write to the display
         """
-        high_nib = data & 0xF0
-        low_nib = (data << 4) & 0xF0
-        self.write4bits(high_nib | mode)
-        self.write4bits(low_nib | mode)
+        _pack_send(self._buf, 0, data, COMMAND | self.backlight)
+        self.i2c.writeto(self.addr, self._buf)
 
-    def write4bits(self, data) -> None:
-        """
-        Write to the diplay and pulse the enable pin.
+    def _send_data(self, data : int) -> None:
         """
-        self.write(data)
-        self.pulse_enable(data)
+        Used internally to write a data byte to the display using the packed byte cache.
 
-    def write(self, data) -> None:
-        """
-        Write the display, automatically setting the backlight bit.
+        Parameters
+        ----------
+        data : int
+            data byte to write to the display
         """
-        self.i2c.writeto(self.addr, bytearray([data | self.backlight]))
+        self.i2c.writeto(self.addr, self._data_bytes(data))
 
     def pulse_enable(self, data) -> None:
         """
-        Pulse the enable pin while keeping the other pins constant.
+        Write the nibble and pulse the enable pin, automatically setting the backlight bit.
+        The display latches on the enable high to low edge so both states are sent
+        as a single 2 byte i2c transaction. Only used during initialization,
+        _send_cmd and _send_data handle full bytes in one transaction.
         """
-        self.write(data | self.ENABLE)
-        self.write(data & ~self.ENABLE)
+        self.i2c.writeto(self.addr, bytearray([data | ENABLE | self.backlight, (data & ~ENABLE) | self.backlight]))
 
     def set_backlight(self, enable : bool) -> None:
         """
@@ -160,27 +189,32 @@ class CHAR_LCD_20_4:
             True for on, False for off
         """
         if(enable):
-            self.backlight = self.BACKLIGHT_ON
+            self.backlight = BACKLIGHT_ON
         else:
-            self.backlight = self.BACKLIGHT_OFF
-        self.send(0, self.COMMAND)
+            self.backlight = BACKLIGHT_OFF
+        # the backlight pin lives on the i2c adapter, not the LCD, so a single
+        # state byte with enable low updates it without clocking a command
+        self.i2c.writeto(self.addr, bytes([self.backlight]))
+        # cached data bytes have the old backlight bit baked in
+        self._data_tbl = [None] * 256
 
     def clear_display(self) -> None:
         """
         Send the clear display command erasing all characters from the screen.
         """
-        self.send(self.CLEAR_DISPLAY, self.COMMAND)
+        self._send_cmd(CLEAR_DISPLAY)
         self.cursor_loc = [0, 0]
-        self.refresh_loc.clear()
-        time.sleep(0.01)
+        self.dirty = [0, 0, 0, 0]
+        # clear needs ~1.52 ms to execute, everything else finishes within the i2c transfer time
+        time.sleep_us(1600)
 
     def return_home(self) -> None:
         """
         Send the return home command setting the cursor location to the top left of the display.
         """
-        self.send(self.RETURN_HOME, self.COMMAND)
+        self._send_cmd(RETURN_HOME)
         self.cursor_loc = [0, 0]
-        time.sleep(0.01)
+        time.sleep_us(1600)
 
     def set_entry_mode(self, dir : int, shift : int) -> None:
         """
@@ -194,8 +228,8 @@ class CHAR_LCD_20_4:
         shift : int
             DISPLAY_SHIFT_ENABLE or DISPLAY_SHIFT_DISABLE
         """
-        data = self.ENTRY_MODE | dir | shift
-        self.send(data, self.COMMAND)
+        data = ENTRY_MODE | dir | shift
+        self._send_cmd(data)
 
     def set_display_control(self, dis : int, cur : int, blink : int) -> None:
         """
@@ -211,8 +245,8 @@ class CHAR_LCD_20_4:
         blink : int
             BLINK_ON or BLINK_OFF
         """
-        data = self.DISPLAY_CONTROL | dis | cur | blink
-        self.send(data, self.COMMAND)
+        data = DISPLAY_CONTROL | dis | cur | blink
+        self._send_cmd(data)
 
     def set_cursur_shift(self, disp_cursor : int, dir : int) -> None:
         """
@@ -227,8 +261,8 @@ class CHAR_LCD_20_4:
         dir : int
             MOVE_RIGHT or MOVE_LEFT
         """
-        data = self.CURSOR_SHIFT | disp_cursor | dir
-        self.send(data, self.COMMAND)
+        data = CURSOR_SHIFT | disp_cursor | dir
+        self._send_cmd(data)
 
     def set_function_control(self, bit_mode : int, lines : int, dots : int) -> None:
         """"
@@ -243,8 +277,8 @@ class CHAR_LCD_20_4:
         dots : int
             DOTS_5X10 or DOTS_5X8
         """
-        data = self.FUNCTION_CONTROL | bit_mode | lines | dots
-        self.send(data, self.COMMAND)
+        data = FUNCTION_CONTROL | bit_mode | lines | dots
+        self._send_cmd(data)
 
     def set_cgram_addr(self, addr : int) -> None:
         """
@@ -256,8 +290,8 @@ class CHAR_LCD_20_4:
         addr : int
             CGRAM address
         """
-        data = self.SET_CGRAM | addr
-        self.send(data, self.COMMAND)
+        data = SET_CGRAM | addr
+        self._send_cmd(data)
 
     def set_ddram_addr(self, addr : int) -> None:
         """
@@ -269,8 +303,8 @@ class CHAR_LCD_20_4:
         addr : int
             DDRAM address
         """
-        data = self.SET_DDRAM | addr
-        self.send(data, self.COMMAND)
+        data = SET_DDRAM | addr
+        self._send_cmd(data)
 
     def write_ram(self, data : int) -> None:
         """
@@ -278,21 +312,71 @@ class CHAR_LCD_20_4:
         Writing to CGRAM will create a custom character.
         Writing the CGRAM address of a character to DDRAM to display that character to the screen.
         """
-        self.send(data, self.DATA)
+        self.i2c.writeto(self.addr, self._data_bytes(data))
 
-    def refresh(self) -> None:
+    def _data_bytes(self, data : int) -> bytes:
         """
-        Refreshes the display using the resfresh_loc list to only update
-        values that need to be updated.
+        Return the 4 packed adapter state bytes for one data byte, caching the
+        result in _data_tbl so repeat characters become a table lookup.
         """
-        for loc in self.refresh_loc:
-            self.set_ddram_addr(self.ddram_map[loc[0]][loc[1]])
-            self.write_ram(self.ddram_value[loc[0]][loc[1]])
-        self.refresh_loc.clear()
+        entry = self._data_tbl[data]
+        if entry is None:
+            buf = bytearray(4)
+            _pack_send(buf, 0, data, DATA | self.backlight)
+            entry = bytes(buf)
+            self._data_tbl[data] = entry
+        return entry
+
+    def refresh(self) -> None:
+        """
+        Refreshes the display using the per row dirty bitmaps to only update
+        values that need to be updated. Consecutive columns in a row only
+        need one set DDRAM address command since the display auto increments
+        its address pointer. Every pending run, including its interleaved set
+        DDRAM address command, is assembled into one buffer and sent as a
+        single i2c burst. Rows with FULL_ROW_THRESHOLD or more dirty cells
+        are rewritten whole, which is cheaper than resetting the address for
+        every run.
+        """
+        buf = self._refresh_buf
+        bl = self.backlight
+        end = 0
+        for row in range(0, 4):
+            dirty = self.dirty[row]
+            if dirty == 0:
+                continue
+            # Kernighan popcount, MicroPython ints have no bit_length or
+            # bit_count and bin() would heap allocate a string per row
+            count = 0
+            d = dirty
+            while d:
+                d &= d - 1
+                count += 1
+            if count >= FULL_ROW_THRESHOLD:
+                # treat the whole row as one run
+                dirty = 0xFFFFF
+            value = self.ddram_value[row]
+            col = 0
+            while dirty:
+                if dirty & 1:
+                    # start of a run of consecutive dirty columns
+                    _pack_send(buf, end, SET_DDRAM | (_ROW_BASE[row] + col), COMMAND | bl)
+                    end += 4
+                    while dirty & 1:
+                        buf[end:end + 4] = self._data_bytes(value[col])
+                        end += 4
+                        dirty >>= 1
+                        col += 1
+                else:
+                    dirty >>= 1
+                    col += 1
+            self.dirty[row] = 0
+        if end > 0:
+            self.i2c.writeto(self.addr, memoryview(buf)[:end])
     
     def set_row(self, row :  int, text : str, wrap=False) -> None:
         """
-        Sets a row in the ddram_map and updates the refresh_loc list.
+        Sets a row of ddram_value and marks changed columns in the dirty bitmap.
 
         Parameters
         ----------
@@ -303,9 +387,14 @@ class CHAR_LCD_20_4:
         wrap : bool
             if true wrap to next row (not yet implemented)
         """
-        text = "{:20}".format(text)
-        
+        if text == self._last_text[row]:
+            return
+        self._last_text[row] = text
+
+        new = text[:20].ljust(20).encode()
+        current = self.ddram_value[row]
+
         for col in range(0, 20):
-            if(ord(text[col]) != self.ddram_value[row][col]):
-                self.ddram_value[row][col] = ord(text[col])
-                self.refresh_loc.append([row, col])
+            if(new[col] ^ current[col]):
+                current[col] = new[col]
+                self.dirty[row] |= 1 << col